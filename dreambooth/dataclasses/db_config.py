@@ -30,6 +30,7 @@ class DreamboothConfig(BaseModel):
     weight_decay: float = 0.01
     attention: str = "xformers"
     cache_latents: bool = True
+    cache_latents_gpu: bool = False
     clip_skip: int = 1
     concepts_list: List[Dict] = []
     concepts_path: str = ""
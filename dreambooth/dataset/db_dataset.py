@@ -1,21 +1,36 @@
+import hashlib
 import json
 import logging
 import os.path
 import random
 import traceback
-from typing import List, Tuple, Union
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple, Union
 
+import numpy as np
 import safetensors.torch
 import torch.utils.data
 from torchvision.transforms import transforms
-from transformers import CLIPTokenizer
+try:
+    from torchvision.transforms import v2
+    # ToImage/ToDtype(scale=True) only exist in torchvision >= 0.16
+    transforms_v2_available = hasattr(v2, "ToImage") and hasattr(v2, "ToPureTensor")
+except ImportError:
+    v2 = None
+    transforms_v2_available = False
+try:
+    from torchvision.io import decode_jpeg, ImageReadMode
+except ImportError:
+    decode_jpeg = None
+from transformers import CLIPTokenizer, CLIPTokenizerFast
 
 from dreambooth import shared
 from dreambooth.dataclasses.prompt_data import PromptData
 from dreambooth.shared import status
 from dreambooth.utils.image_utils import make_bucket_resolutions, \
-    closest_resolution, shuffle_tags, open_and_trim
-from dreambooth.utils.text_utils import build_strict_tokens
+    closest_resolutions, shuffle_tags, open_and_trim, read_jpeg_bytes, resize_and_crop_tensor
+from dreambooth.utils.text_utils import build_strict_tokens, merge_token_chunks
 from helpers.mytqdm import mytqdm
 
 logger = logging.getLogger(__name__)
@@ -32,7 +47,7 @@ class DbDataset(torch.utils.data.Dataset):
             instance_prompts: List[PromptData],
             class_prompts: List[PromptData],
             tokens: List[Tuple[str, str]],
-            tokenizer: Union[CLIPTokenizer, List[CLIPTokenizer], None],
+            tokenizer: Union[CLIPTokenizer, CLIPTokenizerFast, List[CLIPTokenizer], None],
             text_encoder,
             accelerator,
             resolution: int,
@@ -44,7 +59,8 @@ class DbDataset(torch.utils.data.Dataset):
             max_token_length: int,
             debug_dataset: bool,
             model_dir: str,
-            pbar: mytqdm = None
+            pbar: mytqdm = None,
+            cache_latents_gpu: bool = False
     ) -> None:
         super().__init__()
         self.batch_indices = []
@@ -68,6 +84,8 @@ class DbDataset(torch.utils.data.Dataset):
         self.sample_cache = []
         # This is just a list of the sample names that we can use to find where in the cache an image is
         self.sample_indices = []
+        # Maps each sample name to its position in sample_indices, so lookups don't scan the list
+        self.sample_index_map: Dict[str, int] = {}
         # All the available bucket resolutions
         self.resolutions = []
         # Currently active resolution
@@ -84,7 +102,7 @@ class DbDataset(torch.utils.data.Dataset):
         self.num_class_images = len(self.class_img_data)
 
         self.tokenizers = []
-        if isinstance(tokenizer, CLIPTokenizer):
+        if isinstance(tokenizer, (CLIPTokenizer, CLIPTokenizerFast)):
             self.tokenizers = [tokenizer]
         elif isinstance(tokenizer, list):
             self.tokenizers = tokenizer
@@ -100,90 +118,149 @@ class DbDataset(torch.utils.data.Dataset):
         self.vae = None
         self.pbar = pbar
         self.cache_latents = False
+        # How many captions/prompts to push through the tokenizer and text encoders at once while caching
+        self.cache_batch_size = 32
+        # How many images to push through the vae at once while caching latents
+        self.latent_batch_size = 8
+        # How many chunks of images to read ahead of the one being encoded
+        self.prefetch_chunks = 4
+        # Cached latents are kept (and saved) in half precision, they're cast to the training dtype at use
+        self.latent_cache_dtype = torch.float16
+        # SDXL prompt embeds are cached on the cpu in this dtype, so vram use doesn't grow with the dataset
+        self.embeds_cache_dtype = torch.float16
+        self.cache_latents_gpu = cache_latents_gpu
+        # Share of free vram the latent cache may take up before we leave it on the cpu
+        self.gpu_latent_cache_fraction = 0.25
+        # Reusable pinned staging buffer for uploading image batches to the vae
+        self._pin_buf = None
         flip_p = 0.5 if hflip else 0.0
+        self.flip_p = flip_p
         self.image_transforms = self.build_compose(hflip, flip_p)
 
-    def load_cache_file(self):
-        cache_file = os.path.join(self.cache_dir, f"cache_{self.resolution}.safetensors")
-        latents_cache = {}
-        if os.path.exists(cache_file):
-            print("Loading latent cache...")
-            latents_cache = safetensors.torch.load_file(cache_file)
-
-        data_cache = {}
-        for key, value in latents_cache.items():
-            sub_keys = key.split("||")
-            parent_key = sub_keys[0]
-            element_key = sub_keys[1]
+    def prompt_cache_hashes(self) -> Dict[str, str]:
+        """Hash of each image's prompt plus the tokenizer/caption settings, so only edited captions go stale."""
+        settings = [tokenizer.name_or_path for tokenizer in self.tokenizers]
+        # Tag shuffling happens before the sdxl embeds are computed, so they depend on it too
+        settings += [self.strict_tokens, self.not_pad_tokens, self.max_token_length, self.shuffle_tags]
+        settings = json.dumps(settings)
+        hashes = {}
+        for prompt_data in self.train_img_data + self.class_img_data:
+            hashes[prompt_data.src_image] = hashlib.sha256(
+                f"{settings}||{prompt_data.prompt}".encode("utf-8")).hexdigest()
+        return hashes
+
+    def cache_files(self) -> Tuple[str, str]:
+        latents_file = os.path.join(self.cache_dir, f"cache_{self.resolution}.safetensors")
+        text_file = os.path.join(self.cache_dir, f"text_cache_{self.resolution}.safetensors")
+        return latents_file, text_file
 
-            if parent_key not in data_cache:
-                data_cache[parent_key] = {}
+    def load_cache_file(self):
+        latents_file, text_file = self.cache_files()
+        data_cache = {"latents": {}, "sdxl": {}, "captions": {}}
 
-            if parent_key == "sdxl":
-                if len(sub_keys) != 3:
-                    logger.warning(f"Skipping invalid key: {key}")
+        # Latents are only read when we're going to use them, runs without them never touch that file
+        if self.cache_latents and os.path.exists(latents_file):
+            print("Loading latent cache...")
+            with safetensors.safe_open(latents_file, framework="pt") as f:
+                for key in f.keys():
+                    parent_key, _, element_key = key.partition("||")
+                    if parent_key != "latents":
+                        continue
+                    # Older caches were saved in whatever dtype the vae produced
+                    data_cache["latents"][element_key] = f.get_tensor(key).to(dtype=self.latent_cache_dtype)
+
+        # Older versions kept captions/embeds in the latents file
+        text_source = text_file if os.path.exists(text_file) else latents_file
+        if not os.path.exists(text_source):
+            return data_cache
+
+        print("Loading text cache...")
+        with safetensors.safe_open(text_source, framework="pt") as f:
+            metadata = f.metadata() or {}
+            cached_hashes = json.loads(metadata.get("prompt_hashes", "{}"))
+            prompt_hashes = self.prompt_cache_hashes()
+            stale = set()
+            for key in f.keys():
+                sub_keys = key.split("||")
+                parent_key = sub_keys[0]
+                element_key = sub_keys[1]
+
+                if parent_key in ("sdxl", "captions") and cached_hashes.get(element_key) != prompt_hashes.get(element_key):
+                    # Images no longer in the dataset are dropped too, but aren't worth reporting
+                    if element_key in prompt_hashes:
+                        stale.add(element_key)
                     continue
-                main_key = element_key
-                subkey_type = sub_keys[2]
-                if main_key not in data_cache[parent_key]:
-                    data_cache[parent_key][main_key] = [None, {"text_embeds": None, "time_ids": None}]
-
-                if subkey_type == "prompt_embeds":
-                    data_cache[parent_key][main_key][0] = value
-                elif subkey_type == "text_embeds":
-                    data_cache[parent_key][main_key][1]["text_embeds"] = value
-                elif subkey_type == "time_ids":
-                    data_cache[parent_key][main_key][1]["time_ids"] = value
-            else:
-                data_cache[parent_key][element_key] = value
-
-        for key_name in ["latents", "sdxl", "captions"]:
-            if key_name not in data_cache:
-                data_cache[key_name] = {}
 
+                if parent_key == "sdxl":
+                    if len(sub_keys) != 3:
+                        logger.warning(f"Skipping invalid key: {key}")
+                        continue
+                    value = f.get_tensor(key).to(dtype=self.embeds_cache_dtype)
+                    subkey_type = sub_keys[2]
+                    if element_key not in data_cache[parent_key]:
+                        data_cache[parent_key][element_key] = [None, {"text_embeds": None, "time_ids": None}]
+
+                    if subkey_type == "prompt_embeds":
+                        data_cache[parent_key][element_key][0] = value
+                    elif subkey_type == "text_embeds":
+                        data_cache[parent_key][element_key][1]["text_embeds"] = value
+                    elif subkey_type == "time_ids":
+                        data_cache[parent_key][element_key][1]["time_ids"] = value
+                elif parent_key == "captions":
+                    data_cache[parent_key][element_key] = f.get_tensor(key)
+
+        if stale:
+            logger.info(f"Prompts or tokenizer settings changed for {len(stale)} images, re-caching them.")
         return data_cache
 
     def save_cache_file(self, data_cache):
-        cache_file = os.path.join(self.cache_dir, f"cache_{self.resolution}.safetensors")
+        latents_file, text_file = self.cache_files()
 
         try:
             keys_to_check = ["latents", "sdxl", "captions"]
-            do_save = False
             for key_check in keys_to_check:
                 if key_check not in self.data_cache:
                     self.data_cache[key_check] = {}
                 if key_check not in data_cache:
                     data_cache[key_check] = {}
-                if set(key for key, value in self.data_cache[key_check].items()) != set(
-                        key for key, value in data_cache[key_check].items()):
-                    do_save = True
-                    break
-
-            if do_save:
-                print("Saving cache!")
-                if os.path.exists(cache_file):
-                    os.remove(cache_file)
+
+            # Latents weren't loaded or touched unless we're caching them, leave the file alone otherwise
+            if self.cache_latents and set(self.data_cache["latents"].keys()) != set(data_cache["latents"].keys()):
+                print("Saving latent cache!")
+                full_dict = {f"latents||{key}": value for key, value in self.data_cache["latents"].items()}
+                safetensors.torch.save_file(full_dict, latents_file)
+
+            text_changed = any(set(self.data_cache[key].keys()) != set(data_cache[key].keys())
+                               for key in ["sdxl", "captions"])
+            if text_changed or not os.path.exists(text_file):
+                print("Saving text cache!")
                 full_dict = {}
-                for key in keys_to_check:
-                    if key in self.data_cache:
-                        for key2, value in self.data_cache[key].items():
-                            if key == "sdxl":
-                                embeds, extras = value
-                                full_dict[f"{key}||{key2}||prompt_embeds"] = embeds
-                                full_dict[f"{key}||{key2}||text_embeds"] = extras["text_embeds"]
-                                full_dict[f"{key}||{key2}||time_ids"] = extras["time_ids"]
-                            else:
-                                combined_key = f"{key}||{key2}"
-                                full_dict[combined_key] = value
-
-                safetensors.torch.save_file(full_dict, cache_file)
+                for key2, value in self.data_cache["captions"].items():
+                    full_dict[f"captions||{key2}"] = value
+                for key2, (embeds, extras) in self.data_cache["sdxl"].items():
+                    full_dict[f"sdxl||{key2}||prompt_embeds"] = embeds
+                    full_dict[f"sdxl||{key2}||text_embeds"] = extras["text_embeds"]
+                    full_dict[f"sdxl||{key2}||time_ids"] = extras["time_ids"]
+
+                prompt_hashes = self.prompt_cache_hashes()
+                saved_keys = set(self.data_cache["captions"].keys()) | set(self.data_cache["sdxl"].keys())
+                metadata = {"prompt_hashes": json.dumps(
+                    {key: value for key, value in prompt_hashes.items() if key in saved_keys})}
+                safetensors.torch.save_file(full_dict, text_file, metadata=metadata)
         except:
             logger.error("Error saving cache!")
             traceback.print_exc()
 
-
     @staticmethod
     def build_compose(hflip, flip_p):
+        if transforms_v2_available:
+            # Stay in uint8 tensors the whole way, no PIL round-trip
+            image_transforms = [v2.ToImage()]
+            if hflip:
+                image_transforms.append(v2.RandomHorizontalFlip(flip_p))
+            image_transforms += [v2.ToDtype(torch.float32, scale=True), v2.ToPureTensor()]
+            return v2.Compose(image_transforms)
+
         img_augmentation = [transforms.ToPILImage(), transforms.RandomHorizontalFlip(flip_p)]
         to_tensor = [transforms.ToTensor()]
 
@@ -196,31 +273,32 @@ class DbDataset(torch.utils.data.Dataset):
         if self.dynamic_img_norm:
             return img.mean(), img.std()
         else:
-            return [0.5], [0.5]
+            return 0.5, 0.5
 
     def image_transform(self, img):
         img = self.image_transforms(img)
         mean, std = self.get_img_std(img)
-        norm = transforms.Normalize(mean, std)
-        return norm(img)
+        # The transformed tensor is freshly allocated, so normalize it in place
+        return img.sub_(mean).div_(std)
 
-    def encode_prompt(self, prompt):
+    def encode_prompt(self, prompt: Union[str, List[str]]):
         prompt_embeds_list = []
         pooled_prompt_embeds = None  # default declaration
         bs_embed = None  # default declaration
 
+        # Accept a single prompt or a list of prompts, so a whole bucket can be encoded in one pass
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt)
         auto_add_special_tokens = False if self.strict_tokens else True
         if self.shuffle_tags:
-            prompt = shuffle_tags(prompt)
+            prompts = [shuffle_tags(p) for p in prompts]
         for tokenizer, text_encoder in zip(self.tokenizers, self.text_encoders):
             if self.strict_tokens:
-                prompt = build_strict_tokens(prompt, tokenizer.bos_token, tokenizer.eos_token)
+                prompts = [build_strict_tokens(p, tokenizer.bos_token, tokenizer.eos_token) for p in prompts]
 
-            b_size = 1  # as we are working with a single prompt
-            n_size = 1 if self.max_token_length is None else self.max_token_length // 75
+            b_size = len(prompts)
 
             text_inputs = tokenizer(
-                prompt,
+                prompts,
                 padding="max_length",
                 max_length=tokenizer.model_max_length,
                 truncation=True,
@@ -243,11 +321,7 @@ class DbDataset(torch.utils.data.Dataset):
 
             # handle varying max token lengths
             if self.max_token_length is not None:
-                states_list = [prompt_embeds[:, 0].unsqueeze(1)]
-                for i in range(1, self.max_token_length, tokenizer.model_max_length):
-                    states_list.append(prompt_embeds[:, i: i + tokenizer.model_max_length - 2])
-                states_list.append(prompt_embeds[:, -1].unsqueeze(1))
-                prompt_embeds = torch.cat(states_list, dim=1)
+                prompt_embeds = merge_token_chunks(prompt_embeds, self.max_token_length, tokenizer.model_max_length)
 
             if "text_embeds" not in enc_out:
                 # Thanks autopilot!
@@ -255,8 +329,8 @@ class DbDataset(torch.utils.data.Dataset):
             else:
                 # We are only ALWAYS interested in the pooled output of the final text encoder
                 pooled_prompt_embeds = enc_out["text_embeds"]
-            if self.max_token_length is not None:
-                pooled_prompt_embeds = pooled_prompt_embeds[::n_size]
+            # One pooled row per tokenized chunk, keep the first chunk's row for each prompt
+            pooled_prompt_embeds = pooled_prompt_embeds.view(b_size, -1, pooled_prompt_embeds.shape[-1])[:, 0]
 
             bs_embed, seq_len, _ = prompt_embeds.shape
             prompt_embeds = prompt_embeds.view(bs_embed, seq_len, -1)
@@ -267,22 +341,35 @@ class DbDataset(torch.utils.data.Dataset):
         return prompt_embeds, pooled_prompt_embeds
 
     def compute_embeddings(self, reso, prompt):
+        return self.compute_embeddings_batch(reso, [prompt])[0]
+
+    def compute_embeddings_batch(self, reso, prompts: List[str]):
         original_size = reso
         target_size = reso
         crops_coords_top_left = (0, 0)
         with torch.no_grad():
-            prompt_embeds, pooled_prompt_embeds = self.encode_prompt(prompt)
+            prompt_embeds, pooled_prompt_embeds = self.encode_prompt(prompts)
             add_text_embeds = pooled_prompt_embeds
 
             # Adapted from pipeline.StableDiffusionXLPipeline._get_add_time_ids
             add_time_ids = list(original_size + crops_coords_top_left + target_size)
-            add_time_ids = torch.tensor([add_time_ids])
-
-            prompt_embeds = prompt_embeds.to(self.accelerator.device)
-            add_text_embeds = add_text_embeds.to(self.accelerator.device)
-            add_time_ids = add_time_ids.to(self.accelerator.device, dtype=prompt_embeds.dtype)
-            unet_added_cond_kwargs = {"text_embeds": add_text_embeds, "time_ids": add_time_ids}
-        return prompt_embeds, unet_added_cond_kwargs
+            add_time_ids = torch.tensor([add_time_ids] * len(prompts))
+
+            # Cached embeds live on the cpu in half precision, collate moves each batch to the device
+            prompt_embeds = prompt_embeds.to("cpu", dtype=self.embeds_cache_dtype)
+            add_text_embeds = add_text_embeds.to("cpu", dtype=self.embeds_cache_dtype)
+            add_time_ids = add_time_ids.to(dtype=self.embeds_cache_dtype)
+
+        # Split the batch back into per-prompt entries. Clone so each entry owns its storage,
+        # safetensors refuses to save tensors that share memory.
+        results = []
+        for i in range(len(prompts)):
+            unet_added_cond_kwargs = {
+                "text_embeds": add_text_embeds[i:i + 1].clone(),
+                "time_ids": add_time_ids[i:i + 1].clone()
+            }
+            results.append((prompt_embeds[i:i + 1].clone(), unet_added_cond_kwargs))
+        return results
 
     def load_image(self, image_path, caption, res):
         if self.debug_dataset:
@@ -294,42 +381,155 @@ class DbDataset(torch.utils.data.Dataset):
             else:
                 img = open_and_trim(image_path, res, False)
                 image = self.image_transform(img)
-            if self.shuffle_tags:
+            if len(self.tokenizers) > 1:
+                # SDXL swaps input_ids for the prompt embeds, don't tokenize a caption we'd throw away
+                input_ids = None
+            elif self.shuffle_tags:
                 caption, input_ids = self.cache_caption(image_path, caption)
             else:
                 input_ids = self.data_cache["captions"][image_path]
         return image, input_ids
 
-    def cache_latent(self, image_path, res):
-        if self.vae is not None:
-            image = open_and_trim(image_path, res, False)
-            img_tensor = self.image_transform(image)
-            img_tensor = img_tensor.unsqueeze(0).to(device=self.vae.device, dtype=self.vae.dtype)
-            latents = self.vae.encode(img_tensor).latent_dist.sample().squeeze(0).to("cpu")
-            self.data_cache["latents"][image_path] = latents
+    def cache_latents_batch(self, image_paths: List[str], res, on_done: Callable[[str], None] = None) -> List[str]:
+        """
+        Cache latents for a list of same-resolution images, reading and decoding upcoming chunks on a thread pool
+        while the current one is being encoded. on_done is called with each path once it has been processed,
+        whether it succeeded or not. Returns the paths that could not be cached.
+        """
+        failed = []
+        if self.vae is None or not image_paths:
+            return failed
+        batch_size = self.latent_batch_size
+        chunks = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+        # Keep enough reads in flight to saturate fast disks on datasets of many small files
+        max_workers = min(os.cpu_count() or 1, self.prefetch_chunks * batch_size)
+        # Jpegs can skip the cpu decode entirely and go straight to nvjpeg
+        gpu_decode = decode_jpeg is not None and self.vae.device.type == "cuda"
+
+        def read_image(image_path):
+            if gpu_decode:
+                raw = read_jpeg_bytes(image_path)
+                if raw is not None:
+                    return raw
+            return open_and_trim(image_path, res, False)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            def submit(chunk):
+                return [executor.submit(read_image, image_path) for image_path in chunk]
+
+            pending = deque(submit(chunk) for chunk in chunks[:self.prefetch_chunks])
+            for idx, chunk in enumerate(chunks):
+                futures = pending.popleft()
+                if idx + self.prefetch_chunks < len(chunks):
+                    pending.append(submit(chunks[idx + self.prefetch_chunks]))
+                try:
+                    self.encode_latents(chunk, [future.result() for future in futures], res)
+                except Exception:
+                    # Retry one by one, so a single bad image doesn't take the rest of the batch with it
+                    for image_path, future in zip(chunk, futures):
+                        self.sync_staging()
+                        try:
+                            self.encode_latents([image_path], [future.result()], res)
+                        except Exception as e:
+                            traceback.print_exc()
+                            print(f"Exception caching: {image_path}: {e}")
+                            failed.append(image_path)
+                if on_done is not None:
+                    for image_path in chunk:
+                        on_done(image_path)
+        return failed
+
+    def stage_images(self, images: List[np.ndarray]) -> torch.Tensor:
+        """Stack a uint8 image batch and upload it to the vae device, through a pinned buffer when on cuda."""
+        if self.vae.device.type != "cuda":
+            return torch.from_numpy(np.stack(images)).to(self.vae.device)
+        shape = (len(images), *images[0].shape)
+        numel = int(np.prod(shape))
+        if self._pin_buf is None or self._pin_buf.numel() < numel:
+            self._pin_buf = torch.empty(numel, dtype=torch.uint8, pin_memory=True)
+        staged = self._pin_buf[:numel].view(shape)
+        np.stack(images, out=staged.numpy())
+        # The buffer is only rewritten for the next batch after its latents were copied back to the cpu,
+        # which syncs the stream, or after sync_staging() when encoding failed before getting that far.
+        return staged.to(self.vae.device, non_blocking=True)
+
+    def sync_staging(self):
+        """Wait for any in-flight upload from the pinned buffer, so it is safe to overwrite."""
+        if self._pin_buf is not None and self.vae.device.type == "cuda":
+            torch.cuda.current_stream(self.vae.device).synchronize()
+
+    def decode_images(self, image_paths: List[str], images: List[Union[np.ndarray, torch.Tensor]], res) -> torch.Tensor:
+        """
+        Build a (B, H, W, C) uint8 batch on the vae device from decoded arrays and/or raw jpeg bytes,
+        decoding the jpegs on the gpu and falling back to PIL if nvjpeg can't handle one.
+        """
+        if all(isinstance(image, np.ndarray) for image in images):
+            return self.stage_images(images)
+        decoded = []
+        for image_path, image in zip(image_paths, images):
+            if isinstance(image, np.ndarray):
+                decoded.append(torch.from_numpy(image).to(self.vae.device))
+                continue
+            try:
+                image = decode_jpeg(image, mode=ImageReadMode.RGB, device=self.vae.device)
+                decoded.append(resize_and_crop_tensor(image, res).permute(1, 2, 0))
+            except RuntimeError:
+                decoded.append(torch.from_numpy(open_and_trim(image_path, res, False)).to(self.vae.device))
+        return torch.stack(decoded)
+
+    def encode_latents(self, image_paths: List[str], images: List[Union[np.ndarray, torch.Tensor]], res):
+        """Encode same-resolution images, flipping and normalizing on the vae device."""
+        img_tensor = self.decode_images(image_paths, images, res)
+        img_tensor = img_tensor.permute(0, 3, 1, 2).float().div_(255)
+        if self.flip_p > 0:
+            flip = torch.rand(len(images), device=img_tensor.device) < self.flip_p
+            img_tensor = torch.where(flip[:, None, None, None], img_tensor.flip(-1), img_tensor)
+        if self.dynamic_img_norm:
+            mean = img_tensor.mean(dim=(1, 2, 3), keepdim=True)
+            std = img_tensor.std(dim=(1, 2, 3), keepdim=True)
+            img_tensor = img_tensor.sub_(mean).div_(std)
+        else:
+            img_tensor = img_tensor.sub_(0.5).div_(0.5)
+        img_tensor = img_tensor.to(dtype=self.vae.dtype)
+        latents = self.vae.encode(img_tensor).latent_dist.sample().to("cpu", dtype=self.latent_cache_dtype)
+        for image_path, latent in zip(image_paths, latents):
+            self.data_cache["latents"][image_path] = latent.clone(memory_format=torch.contiguous_format)
+
+    def tokenize_captions(self, captions: List[str]) -> List[torch.Tensor]:
+        """Tokenize a list of captions in a single tokenizer call, returning one (1, N) tensor per caption."""
+        auto_add_special_tokens = False if self.strict_tokens else True
+        padding = True if self.not_pad_tokens else 'max_length'
+        text_inputs = self.tokenizers[0](captions, padding=padding, truncation=True,
+                                         add_special_tokens=auto_add_special_tokens,
+                                         return_tensors='pt')
+        input_ids = text_inputs.input_ids
+        if self.not_pad_tokens and len(captions) > 1:
+            # Batching pads to the longest caption, trim each row back to its own length
+            lengths = text_inputs.attention_mask.sum(dim=1).tolist()
+            return [input_ids[i:i + 1, :length].clone() for i, length in enumerate(lengths)]
+        return [ids.clone() for ids in input_ids.split(1)]
 
     def cache_caption(self, image_path, caption):
         input_ids = None
-        auto_add_special_tokens = False if self.strict_tokens else True
         if len(self.tokenizers) > 0 and (image_path not in self.data_cache["captions"] or self.debug_dataset):
             if self.shuffle_tags:
                 caption = shuffle_tags(caption)
             if self.strict_tokens:
                 caption = build_strict_tokens(caption, self.tokenizers[0].bos_token, self.tokenizers[0].eos_token)
-            if self.not_pad_tokens:
-                input_ids = self.tokenizers[0](caption, padding=True, truncation=True,
-                                               add_special_tokens=auto_add_special_tokens,
-                                               return_tensors="pt").input_ids
-            else:
-                input_ids = self.tokenizers[0](caption, padding='max_length', truncation=True,
-                                               add_special_tokens=auto_add_special_tokens,
-                                               return_tensors='pt').input_ids
+            input_ids = self.tokenize_captions([caption])[0]
             if not self.shuffle_tags:
                 self.data_cache["captions"][image_path] = input_ids
 
         return caption, input_ids
 
-
+    def cache_captions_batch(self, image_paths: List[str], captions: List[str]):
+        if len(self.tokenizers) == 0 or not image_paths:
+            return
+        if self.strict_tokens:
+            bos_token, eos_token = self.tokenizers[0].bos_token, self.tokenizers[0].eos_token
+            captions = [build_strict_tokens(caption, bos_token, eos_token) for caption in captions]
+        for image_path, input_ids in zip(image_paths, self.tokenize_captions(captions)):
+            self.data_cache["captions"][image_path] = input_ids
 
     def make_buckets_with_caching(self, vae):
         self.vae = vae
@@ -345,11 +545,10 @@ class DbDataset(torch.utils.data.Dataset):
         self.train_dict = {}
 
         def sort_images(img_data: List[PromptData], resolutions, target_dict, is_class_img):
-            for prompt_data in img_data:
+            resos = closest_resolutions([prompt_data.resolution for prompt_data in img_data], resolutions)
+            for prompt_data, reso in zip(img_data, resos):
                 path = prompt_data.src_image
-                image_width, image_height = prompt_data.resolution
                 cap = prompt_data.prompt
-                reso = closest_resolution(image_width, image_height, resolutions)
                 concept_idx = prompt_data.concept_index
                 # Append the concept index to the resolution, and boom, we got ourselves split concepts.
                 di = (*reso, concept_idx)
@@ -369,8 +568,9 @@ class DbDataset(torch.utils.data.Dataset):
         shared.status.job_no = 0
         total_instances = 0
         total_classes = 0
-        data_cache = self.load_cache_file() if self.cache_latents else {}
-        has_cache = len(data_cache) > 0
+        # Captions and SDXL embeddings are worth restoring even when latents aren't cached
+        data_cache = self.load_cache_file()
+        has_cache = len(data_cache["latents"]) > 0
         if self.cache_latents:
             if has_cache:
                 bar_description = "Loading cached latents..."
@@ -384,46 +584,118 @@ class DbDataset(torch.utils.data.Dataset):
             self.pbar.reset(total=p_len)
             self.pbar.set_description(bar_description)
         self.pbar.status_index = 1
+        def uncache_image(img_path):
+            for cache in self.data_cache.values():
+                cache.pop(img_path, None)
+
         def cache_images(images, reso, p_bar: mytqdm):
+            # Latents, captions and SDXL embeddings are collected here and encoded per bucket in batches
+            pending_latents = []
+            pending_captions = []
+            pending_embeds = []
+            failed = set()
+            # Images still waiting on a batched stage, the progress bar ticks once all of an image's stages are done
+            pending_stages = {}
+
+            def mark_done(img_path):
+                pending_stages[img_path] -= 1
+                if pending_stages[img_path] == 0:
+                    p_bar.update()
+
+            cache_captions = not self.shuffle_tags and len(self.tokenizers) != 2
+            cache_embeds = len(self.tokenizers) == 2
+            latents_cache = data_cache["latents"]
+            captions_cache = data_cache["captions"]
+            sdxl_cache = data_cache["sdxl"]
             for img_path, cap, is_prior in images:
+                stages = 0
                 try:
-                    # If the image is not in the "precache",cache it
+                    # Restore whatever the on-disk cache already has, queue the rest to be cached in batches
                     if self.cache_latents:
-                        if img_path not in data_cache["latents"] and not self.debug_dataset:
-                                self.cache_latent(img_path, reso)
-                        else:
-                            self.data_cache["latents"][img_path] = data_cache["latents"][img_path]
-
-                    if not self.shuffle_tags:
-                        if img_path not in data_cache["captions"] and not self.debug_dataset:
-                            self.cache_caption(img_path, cap)
+                        cached = latents_cache.get(img_path)
+                        if cached is not None:
+                            self.data_cache["latents"][img_path] = cached
+                        elif not self.debug_dataset:
+                            pending_latents.append((img_path, cap, is_prior))
+                            stages += 1
+
+                    # SDXL trains on the prompt embeds below, so the tokenized caption is never used
+                    if cache_captions:
+                        cached = captions_cache.get(img_path)
+                        if cached is not None:
+                            self.data_cache["captions"][img_path] = cached
+                        elif not self.debug_dataset:
+                            pending_captions.append((img_path, cap, is_prior))
+                            stages += 1
+
+                    if cache_embeds:
+                        cached = sdxl_cache.get(img_path)
+                        if cached is not None:
+                            self.data_cache["sdxl"][img_path] = cached
                         else:
-                            self.data_cache["captions"][img_path] = data_cache["captions"][img_path]
-
-                    # This likely needs to happen regardless of cache_latents?
-                    if len(self.tokenizers) == 2:
-                        if img_path not in data_cache["sdxl"]:
-                            embeds, extras = self.compute_embeddings(reso, cap)
-                            self.data_cache["sdxl"][img_path] = (embeds, extras)
-                        else:
-                            self.data_cache["sdxl"][img_path] = data_cache["sdxl"][img_path]
-
-                    self.sample_indices.append(img_path)
-                    self.sample_cache.append((img_path, cap, is_prior))
-                    p_bar.update()
+                            pending_embeds.append((img_path, cap, is_prior))
+                            stages += 1
                 except Exception as e:
                     traceback.print_exc()
                     print(f"Exception caching: {img_path}: {e}")
-                    if img_path in self.data_cache["captions"]:
-                        del self.data_cache["captions"][img_path]
-                    if img_path in self.data_cache["latents"]:
-                        del self.data_cache["latents"][img_path]
-                    if img_path in self.data_cache["sdxl"]:
-                        del self.data_cache["sdxl"][img_path]
-                    if (img_path, cap, is_prior) in self.sample_cache:
-                        self.sample_cache.remove((img_path, cap, is_prior))
-                    if img_path in self.sample_indices:
-                        del self.sample_indices[img_path]
+                    uncache_image(img_path)
+                    failed.add(img_path)
+                if stages:
+                    pending_stages[img_path] = pending_stages.get(img_path, 0) + stages
+                else:
+                    p_bar.update()
+
+            latent_paths = [c[0] for c in pending_latents if c[0] not in failed]
+            for c in pending_latents:
+                if c[0] in failed:
+                    mark_done(c[0])
+            for img_path in self.cache_latents_batch(latent_paths, reso, on_done=mark_done):
+                uncache_image(img_path)
+                failed.add(img_path)
+
+            def cache_in_batches(pending, cache_fn):
+                for start in range(0, len(pending), self.cache_batch_size):
+                    chunk = []
+                    for entry in pending[start:start + self.cache_batch_size]:
+                        if entry[0] in failed:
+                            mark_done(entry[0])
+                        else:
+                            chunk.append(entry)
+                    if not chunk:
+                        continue
+                    try:
+                        cache_fn(chunk)
+                    except Exception:
+                        # Retry one by one, so a single bad prompt doesn't take the rest of the batch with it
+                        for entry in chunk:
+                            try:
+                                cache_fn([entry])
+                            except Exception as e:
+                                traceback.print_exc()
+                                print(f"Exception caching: {entry[0]}: {e}")
+                                uncache_image(entry[0])
+                                failed.add(entry[0])
+                    for entry in chunk:
+                        mark_done(entry[0])
+
+            def tokenize_chunk(chunk):
+                self.cache_captions_batch([c[0] for c in chunk], [c[1] for c in chunk])
+
+            def embed_chunk(chunk):
+                embeddings = self.compute_embeddings_batch(reso, [c[1] for c in chunk])
+                for (img_path, _, _), (embeds, extras) in zip(chunk, embeddings):
+                    self.data_cache["sdxl"][img_path] = (embeds, extras)
+
+            cache_in_batches(pending_captions, tokenize_chunk)
+            cache_in_batches(pending_embeds, embed_chunk)
+
+            # Only register samples once everything they need is cached, and drop the ones that failed
+            if failed:
+                images[:] = [image for image in images if image[0] not in failed]
+            for img_path, cap, is_prior in images:
+                self.sample_index_map.setdefault(img_path, len(self.sample_indices))
+                self.sample_indices.append(img_path)
+                self.sample_cache.append((img_path, cap, is_prior))
 
         bucket_dict = {}
 
@@ -432,10 +704,12 @@ class DbDataset(torch.utils.data.Dataset):
                 continue
             # Separate the resolution from the index where we need it
             res = (dict_idx[0], dict_idx[1])
-            # This should really be the index, because we want the bucket sampler to shuffle them all
-            self.resolutions.append(dict_idx)
             # Cache with the actual res, because it's used to crop
             cache_images(train_images, res, self.pbar)
+            if not train_images:
+                continue
+            # This should really be the index, because we want the bucket sampler to shuffle them all
+            self.resolutions.append(dict_idx)
             inst_count = len(train_images)
             class_count = 0
             if dict_idx in self.class_dict:
@@ -444,6 +718,8 @@ class DbDataset(torch.utils.data.Dataset):
                 # Use actual res here as well
                 cache_images(class_images, res, self.pbar)
                 class_count = len(class_images)
+                if not class_images:
+                    del self.class_dict[dict_idx]
             total_instances += inst_count
             total_classes += class_count
             example_len = inst_count if class_count == 0 else inst_count * 2
@@ -468,6 +744,9 @@ class DbDataset(torch.utils.data.Dataset):
             f.write(json.dumps(bucket_array, indent=4))
         self.save_cache_file(data_cache)
         del data_cache
+        # Only needed while caching, don't hold on to the pinned memory for the whole run
+        self._pin_buf = None
+        self.move_latents_to_device()
         bucket_str = str(bucket_idx).rjust(max_idx_chars, " ")
         inst_str = str(total_instances).rjust(len(str(ni)), " ")
         class_str = str(total_classes).rjust(len(str(nc)), " ")
@@ -479,30 +758,46 @@ class DbDataset(torch.utils.data.Dataset):
         print(f"\nTotal images / batch: {self._length}, total examples: {total_len}")
         self.pbar.reset(0)
 
+    def move_latents_to_device(self):
+        """Keep the latent cache on the gpu when it comfortably fits, instead of uploading it every batch."""
+        device = getattr(self.accelerator, "device", None)
+        if not self.cache_latents_gpu or not self.cache_latents or self.debug_dataset:
+            return
+        if device is None or device.type != "cuda":
+            return
+        latents = self.data_cache["latents"]
+        total_bytes = sum(t.numel() * t.element_size() for t in latents.values())
+        free_bytes, _ = torch.cuda.mem_get_info(device)
+        if total_bytes == 0 or total_bytes > free_bytes * self.gpu_latent_cache_fraction:
+            return
+        logger.info(f"Moving {total_bytes / 1024 ** 2:.1f}MB of cached latents to {device}.")
+        self.data_cache["latents"] = {key: value.to(device) for key, value in latents.items()}
+
     def shuffle_buckets(self):
         sample_dict = {}
-        batch_indices = []
-        batch_samples = []
+        # self._length is the total example count across buckets, so these never need to grow
+        batch_samples = [None] * self._length
+        pos = 0
         keys = list(self.train_dict.keys())
         if not self.debug_dataset:
             random.shuffle(keys)
         for key in keys:
-            sample_list = []
+            train_entries = self.train_dict[key]
             if not self.debug_dataset:
-                random.shuffle(self.train_dict[key])
-            for entry in self.train_dict[key]:
-                sample_list.append(entry)
-                batch_indices.append(entry[0])
-                batch_samples.append(entry)
-                if key in self.class_dict:
-                    class_entries = self.class_dict[key]
-                    selection = random.choice(class_entries)
-                    batch_indices.append(selection[0])
-                    batch_samples.append(selection)
-                    sample_list.append(selection)
+                random.shuffle(train_entries)
+            if key in self.class_dict:
+                # Interleave each instance image with a randomly selected class image
+                sample_list = [None] * (len(train_entries) * 2)
+                sample_list[0::2] = train_entries
+                sample_list[1::2] = random.choices(self.class_dict[key], k=len(train_entries))
+            else:
+                sample_list = list(train_entries)
+            batch_samples[pos:pos + len(sample_list)] = sample_list
+            pos += len(sample_list)
             sample_dict[key] = sample_list
+        del batch_samples[pos:]
         self.sample_dict = sample_dict
-        self.batch_indices = batch_indices
+        self.batch_indices = [entry[0] for entry in batch_samples]
         self.batch_samples = batch_samples
 
     def __len__(self):
@@ -522,7 +817,7 @@ class DbDataset(torch.utils.data.Dataset):
         repeats = 0
         # Grab instance image data
         image_path, caption, is_class_image = bucket[img_index]
-        image_index = self.sample_indices.index(image_path)
+        image_index = self.sample_index_map[image_path]
 
         img_index += 1
 
@@ -544,7 +839,7 @@ class DbDataset(torch.utils.data.Dataset):
                 if image_path in self.data_cache["sdxl"]:
                     input_ids, added_conditions = self.data_cache["sdxl"][image_path]
                 else:
-                    input_ids, added_conditions = self.compute_embeddings(self.active_resolution, caption)
+                    input_ids, added_conditions = self.compute_embeddings(self.active_resolution[:2], caption)
                     self.data_cache["sdxl"][image_path] = (input_ids, added_conditions)
                 example["instance_added_cond_kwargs"] = added_conditions
         else:
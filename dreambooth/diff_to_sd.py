@@ -1,7 +1,6 @@
 # Script for converting Diffusers saved pipeline to a Stable Diffusion checkpoint.
 # *Only* converts the UNet, VAE, and Text Encoder.
 # Does not convert optimizer state or any other thing.
-import copy
 import logging
 import os
 import os.path as osp
@@ -439,7 +438,7 @@ def compile_checkpoint(model_name: str, lora_file_name: str = None, reload_model
         if lora_file_name:
             unet_model = UNet2DConditionModel().from_pretrained(os.path.dirname(unet_path))
             lora_rev = apply_lora(config, unet_model, lora_file_name, "cpu", False)
-            unet_state_dict = copy.deepcopy(unet_model.state_dict())
+            unet_state_dict = unet_model.state_dict()
             del unet_model
             if lora_rev is not None:
                 checkpoint_path = os.path.join(models_path, f"{save_model_name}_{lora_rev}_lora{checkpoint_ext}")
@@ -479,7 +478,7 @@ def compile_checkpoint(model_name: str, lora_file_name: str = None, reload_model
             )
 
             apply_lora(config, text_encoder, lora_txt_file_name, "cpu", True)
-            text_enc_dict = copy.deepcopy(text_encoder.state_dict())
+            text_enc_dict = text_encoder.state_dict()
             del text_encoder
         else:
             text_enc_dict = load_model(text_enc_path, map_location="cpu")
@@ -322,7 +322,7 @@ def main(class_gen_method: str = "Native Diffusers", user: str = None) -> TrainR
         tokenizer = AutoTokenizer.from_pretrained(
             os.path.join(pretrained_path, "tokenizer"),
             revision=args.revision,
-            use_fast=False,
+            use_fast=True,
         )
 
         tokenizer_two = None
@@ -333,7 +333,7 @@ def main(class_gen_method: str = "Native Diffusers", user: str = None) -> TrainR
             tokenizer_two = AutoTokenizer.from_pretrained(
                 os.path.join(pretrained_path, "tokenizer_2"),
                 revision=args.revision,
-                use_fast=False,
+                use_fast=True,
             )
 
         # import correct text encoder class
@@ -734,9 +734,15 @@ def main(class_gen_method: str = "Native Diffusers", user: str = None) -> TrainR
             pixel_values = torch.stack(pixel_values)
             pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
 
-            input_ids = torch.cat(input_ids, dim=0)
-            add_text_embeds = torch.cat(add_text_embeds, dim=0)
-            add_time_ids = torch.cat(add_time_ids, dim=0)
+            # The dataset keeps embeds on the cpu in half precision, pin and upload them once per batch
+            def to_device(tensor):
+                if tensor.device.type == "cpu" and accelerator.device.type == "cuda":
+                    tensor = tensor.pin_memory()
+                return tensor.to(accelerator.device, dtype=weight_dtype, non_blocking=True)
+
+            input_ids = to_device(torch.cat(input_ids, dim=0))
+            add_text_embeds = to_device(torch.cat(add_text_embeds, dim=0))
+            add_time_ids = to_device(torch.cat(add_time_ids, dim=0))
 
             batch = {
                 "input_ids": input_ids,
@@ -1495,7 +1501,7 @@ def main(class_gen_method: str = "Native Diffusers", user: str = None) -> TrainR
                     # Convert images to latent space
                     with torch.no_grad():
                         if args.cache_latents:
-                            latents = batch["images"].to(accelerator.device)
+                            latents = batch["images"].to(accelerator.device, dtype=weight_dtype)
                         else:
                             latents = vae.encode(
                                 batch["images"].to(dtype=weight_dtype)
@@ -58,7 +58,7 @@ def generate_dataset(
         tokenizer = AutoTokenizer.from_pretrained(
             os.path.join(args.pretrained_model_name_or_path, "tokenizer"),
             revision=args.revision,
-            use_fast=False,
+            use_fast=True,
         )
 
     tokens = []
@@ -87,7 +87,8 @@ def generate_dataset(
         max_token_length=max_token_length,
         debug_dataset=debug,
         model_dir=model_dir,
-        pbar=pbar
+        pbar=pbar,
+        cache_latents_gpu=args.cache_latents_gpu
     )
     train_dataset.make_buckets_with_caching(vae)
 
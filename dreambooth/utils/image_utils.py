@@ -287,6 +287,19 @@ def closest_resolution(img_w, img_h, resos) -> Tuple[int, int]:
     return min(resos, key=distance)
 
 
+def closest_resolutions(sizes: List[Tuple[int, int]], resos) -> List[Tuple[int, int]]:
+    """Vectorized closest_resolution for many (width, height) pairs at once."""
+    if not len(sizes):
+        return []
+    sizes_arr = np.asarray(sizes, dtype=np.float64)
+    resos_arr = np.asarray(resos, dtype=np.float64)
+    img_ratios = sizes_arr[:, 0] / sizes_arr[:, 1]
+    res_ratios = resos_arr[:, 0] / resos_arr[:, 1]
+    # argmin picks the first of any ties, same as min() in closest_resolution
+    idx = np.abs(img_ratios[:, None] - res_ratios[None, :]).argmin(axis=1)
+    return [tuple(resos[i]) for i in idx]
+
+
 txt2img_available = False
 try:
     from modules import devices, sd_hijack, prompt_parser, lowvram
@@ -487,6 +500,42 @@ def open_and_trim(image_path: str, reso: Tuple[int, int], return_pil: bool = Fal
         return np.array(image)
 
 
+def read_jpeg_bytes(image_path: str) -> Union[torch.Tensor, None]:
+    """
+    Read the raw bytes of a jpeg that can be decoded as-is, for decoding on the gpu. Returns None for anything
+    that needs the PIL path in open_and_trim (other formats, exif rotation, odd color modes).
+    """
+    if os.path.splitext(image_path)[1].lower() not in (".jpg", ".jpeg"):
+        return None
+    with Image.open(image_path) as image:
+        if image.mode not in ("RGB", "L"):
+            return None
+        orientation = image.getexif().get(0x0112)
+        if orientation in (3, 6, 8):
+            return None
+    with open(image_path, "rb") as f:
+        return torch.frombuffer(bytearray(f.read()), dtype=torch.uint8)
+
+
+def resize_and_crop_tensor(image: torch.Tensor, reso: Tuple[int, int]) -> torch.Tensor:
+    """Tensor (C, H, W uint8) equivalent of the resize and center crop done by open_and_trim."""
+    height, width = image.shape[-2:]
+    scale_factor = max(reso[0] / width, reso[1] / height)
+    if scale_factor != 1:
+        new_size = (int(height * scale_factor), int(width * scale_factor))
+        image = torch.nn.functional.interpolate(
+            image.unsqueeze(0).float(), size=new_size, mode="bicubic", antialias=True, align_corners=False
+        ).squeeze(0).round_().clamp_(0, 255).to(torch.uint8)
+        height, width = new_size
+    if width != reso[0] or height != reso[1]:
+        w = int((width - reso[0]) / 2)
+        h = int((height - reso[1]) / 2)
+        # Negative padding crops, positive pads with black like PIL's crop() does when the resize undershoots
+        image = torch.nn.functional.pad(image, (-w, w + reso[0] - width, -h, h + reso[1] - height))
+    assert image.shape[-2:] == (reso[1], reso[0]), f"Expected {reso}, got {tuple(image.shape[-2:])}"
+    return image
+
+
 def db_save_image(image: Image, prompt_data: PromptData = None, save_txt: bool = True, custom_name: str = None):
     image_base = hashlib.sha1(image.tobytes()).hexdigest()
 
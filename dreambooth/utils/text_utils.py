@@ -9,6 +9,28 @@ from transformers import CLIPTextModel
 from dreambooth.dataclasses.prompt_data import PromptData
 
 
+# (seq_len, max_token_length, tokenizer_max_length, device) -> indices used by merge_token_chunks
+token_chunk_indices = {}
+
+
+def merge_token_chunks(hidden_states: torch.Tensor, max_token_length: int, tokenizer_max_length: int):
+    """
+    Keep the first state, the inner states of each tokenizer_max_length chunk and the last state, dropping the
+    per-chunk BOS/EOS in between. Done as a single cached index_select rather than a list of slices + torch.cat.
+    """
+    seq_len = hidden_states.shape[1]
+    key = (seq_len, max_token_length, tokenizer_max_length, str(hidden_states.device))
+    indices = token_chunk_indices.get(key)
+    if indices is None:
+        index_list = [0]
+        for i in range(1, max_token_length, tokenizer_max_length):
+            index_list.extend(range(i, min(i + tokenizer_max_length - 2, seq_len)))
+        index_list.append(seq_len - 1)
+        indices = torch.tensor(index_list, dtype=torch.long, device=hidden_states.device)
+        token_chunk_indices[key] = indices
+    return hidden_states.index_select(1, indices)
+
+
 # Implementation from https://github.com/bmaltais/kohya_ss
 def encode_hidden_state(text_encoder: CLIPTextModel, input_ids, pad_tokens, b_size, max_token_length,
                         tokenizer_max_length, clip_skip):
@@ -28,11 +50,7 @@ def encode_hidden_state(text_encoder: CLIPTextModel, input_ids, pad_tokens, b_si
     encoder_hidden_states = encoder_hidden_states.reshape((b_size, -1, encoder_hidden_states.shape[-1]))
 
     if max_token_length > 75:
-        sts_list = [encoder_hidden_states[:, 0].unsqueeze(1)]
-        for i in range(1, max_token_length, tokenizer_max_length):
-            sts_list.append(encoder_hidden_states[:, i:i + tokenizer_max_length - 2])
-        sts_list.append(encoder_hidden_states[:, -1].unsqueeze(1))
-        encoder_hidden_states = torch.cat(sts_list, dim=1)
+        encoder_hidden_states = merge_token_chunks(encoder_hidden_states, max_token_length, tokenizer_max_length)
 
     return encoder_hidden_states
 
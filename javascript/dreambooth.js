@@ -366,6 +366,7 @@ let db_titles = {
     "Image Generation Scheduler": "Model scheduler to use. Only applies to models before 2.0.",
     "Instance Prompt": "A prompt describing the subject. Use [Filewords] to parse image filename/.txt to insert existing prompt here.",
     "Instance Token": "When using [filewords], this is the instance identifier that is unique to your subject. Should be a single word.",
+    "Keep Cached Latents on GPU": "Move the cached latents to the GPU once if they fit in a small share of free VRAM, instead of uploading them every step. Uses more VRAM.",
     "Learning Rate Scheduler": "The learning rate scheduler to use. All schedulers use the provided warmup time except for 'constant'. For dadapt_with_warmup it 10% total steps is recommended. You may need to add additional epochs to compensate.",
     "Learning Rate Warmup Steps": "Number of steps for the warmup in the lr scheduler. LR will start at 0 and increase to this value over the specified number of steps.",
     "Learning Rate": "The rate at which the model learns. Default is 2e-6. For optimizers with D-Adaptation recommended learning rate is 1.0",
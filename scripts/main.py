@@ -623,6 +623,9 @@ def on_ui_tabs():
                             db_cache_latents = gr.Checkbox(
                                 label="Cache Latents", value=True
                             )
+                            db_cache_latents_gpu = gr.Checkbox(
+                                label="Keep Cached Latents on GPU", value=False
+                            )
                             db_train_unet = gr.Checkbox(
                                 label="Train UNET", value=True
                             )
@@ -1319,6 +1322,7 @@ def on_ui_tabs():
             db_weight_decay,
             db_attention,
             db_cache_latents,
+            db_cache_latents_gpu,
             db_clip_skip,
             db_concepts_path,
             db_custom_model_name,